@@ -13,18 +13,20 @@ Options:
     --TD=<FILE>             Specify trading dates file.
     --TK=<TOKEN>            Specify tushare-token for trading calendar [default: xxli].
     --rebate-file=<FILE>    Specify return configuration file [default: rebate.csv].
+    --broker-conf=<FILE>    Specify broker dialect configuration file [default: brokers.yml].
+    --resume                Reuse CTP files parsed by a previous run; quarantined files are retried.
+    --encoding=<ENC>        Specify encoding of CTP files, e.g. gbk, gb18030 or utf-8 [default: auto].
 """
 
 
-from docopt import docopt
-import numpy as np
-import pandas as pd
 import os
+import re
 import sys
+import mmap
+import codecs
 from datetime import datetime, timedelta
-import tushare as ts
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
+from journal import file_signature, load_journal, append_journal, compact_journal, error_record
+# numpy、pandas、yaml、tushare、matplotlib等较重的依赖在使用处导入，以缩短启动时间
 
 
 TABLES = ('资金状况', '成交记录', '出入金明细', '平仓明细', '持仓明细', '持仓汇总')
@@ -39,12 +41,113 @@ COMMISSION = (
     ('DCE_IND_COMM', ('BB', 'FB', 'I', 'J', 'JM', 'L', 'PP', 'V', 'EG')), # 大商所9个工业品品种
     ('DCE_AGR_COMM', ('A', 'B', 'C', 'CS', 'JD', 'M', 'P', 'Y')) # 大商所8个农产品品种
 )
+REBATE = (
+    ('CFFEX', '中金所手续费'),
+    ('INE', '上期原油手续费'),
+    ('SHFE', '上期所手续费'),
+    ('CZCE', '郑商所手续费'),
+    ('DCE_IND', '大商所工业品手续费'),
+    ('DCE_AGR', '大商所农产品手续费')
+)  # 返还配置列与结算总表手续费列对应关系
 EPSILON = 0.001  # 匹配误差容忍度
+JOURNAL_FILE = 'journal.jsonl'  # CTP文件解析日志
+QUARANTINE_FILE = 'quarantine.jsonl'  # 解析失败的CTP文件记录
+PARTIAL_EXIT = 3  # 已生成结算表但有结算单被隔离时的退出码
+ENCODINGS = ('utf-8', 'gb18030')  # 自动识别的编码，gb18030兼容gbk
+SAMPLE_SIZE = 1 << 16  # 编码识别采样字节数
 
 
-def extract_data(filepath):
-    with open(filepath) as f:
-        contents = f.readlines()
+def detect_encoding(buf):
+    """
+    识别CTP文件编码（utf-8或gb18030）
+    """
+    if buf[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+        return 'utf-8-sig'
+    sample = buf[:SAMPLE_SIZE]
+    for encoding in ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=len(sample) < SAMPLE_SIZE)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    raise ValueError('无法识别CTP文件编码，请使用--encoding指定')
+
+
+def statement_bounds(buf, encoding, markers, header_matcher):
+    """
+    按字节扫描多日结算单的分界位置，返回各结算单的(起始, 结束)字节偏移；
+    markers为各期货公司的客户号标签，以文件中最先出现的标签划分结算单，
+    每个结算单以其客户号之前最近的期货公司表头行作为起始行
+    """
+    positions = []
+    for marker in markers:
+        marker = marker.encode(encoding.replace('-sig', ''))
+        pos = buf.find(marker)
+        if pos == -1 or (len(positions) > 0 and pos > positions[0]):
+            continue
+        positions = []
+        while pos != -1:
+            positions.append(pos)
+            pos = buf.find(marker, pos + len(marker))
+    if len(positions) <= 1:
+        return [(0, len(buf))]
+    starts = [0]
+    for prev, pos in zip(positions, positions[1:]):
+        # 自客户号所在行向前逐行查找表头，至多回溯到上一个客户号所在行之后；未找到时以客户号所在行起始
+        lower = buf.find(b'\n', prev) + 1
+        start = line_end = buf.rfind(b'\n', 0, pos) + 1
+        while line_end > lower:
+            line_start = buf.rfind(b'\n', lower, line_end - 1) + 1 or lower
+            line = buf[line_start:line_end].decode(encoding.replace('-sig', ''), errors='ignore')
+            if header_matcher.search(line) is not None:
+                start = line_start
+                break
+            line_end = line_start
+        starts.append(start)
+    return list(zip(starts, starts[1:] + [len(buf)]))
+
+
+def client_id_markers(registry):
+    """
+    各期货公司配置的客户号标签，用于划分多日结算单
+    """
+    return sorted(set([dialect['labels']['client_id'] for dialect in registry['dialects'].values()]))
+
+
+def count_statements(filepath, registry, encoding=None):
+    """
+    统计CTP文件中的结算单数量，仅按字节扫描客户号标签，不解析结算单内容
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if encoding is None:
+                encoding = detect_encoding(buf)
+            return len(statement_bounds(buf, encoding, client_id_markers(registry), registry['header_matcher']))
+
+
+def read_statements(filepath, registry, encoding=None):
+    """
+    以内存映射方式读取CTP文件，逐个返回结算单的文本行；
+    单个文件可包含多日结算单，仅解码当前结算单对应的字节片段
+    """
+    markers = client_id_markers(registry)
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if encoding is None:
+                encoding = detect_encoding(buf)
+            for start, end in statement_bounds(buf, encoding, markers, registry['header_matcher']):
+                text = buf[start:end].decode(encoding)
+                yield text.replace('\r\n', '\n').replace('\r', '\n').splitlines(True)
+
+
+def extract_statement(contents, registry):
+    """
+    解析单个结算单
+    """
     row_id = 0
     block_prev = ''
     stats = {}
@@ -53,11 +156,11 @@ def extract_data(filepath):
             if TABLE in contents[i]:
                 block_content = contents[row_id:i]
                 if row_id == 0:
-                    stats = {**stats, **process_head(block_content)}
+                    stats = {**stats, **process_head(block_content, registry)}
                 elif block_prev == '资金状况':
                     stats = {**stats, **process_summary(block_content)}
                 elif block_prev == '出入金明细':
-                    _stats = process_deposit_withdrawal(block_content, stats['company'])
+                    _stats = process_deposit_withdrawal(block_content, registry['dialects'][stats['company']])
                     if abs(stats['total_deposit_withdrawal'] - _stats['total_deposit_withdrawal']) > EPSILON:
                         print('WARNING! 资金状况出入金(%.2f)与出入金明细不匹配(%.2f)！' 
                               % (stats['total_deposit_withdrawal'], _stats['total_deposit_withdrawal']))
@@ -71,7 +174,7 @@ def extract_data(filepath):
     if block_prev == '资金状况':
         stats = {**stats, **process_summary(block_content)}
     elif block_prev == '出入金明细':
-        _stats = process_deposit_withdrawal(block_content, stats['company'])
+        _stats = process_deposit_withdrawal(block_content, registry['dialects'][stats['company']])
         if abs(stats['total_deposit_withdrawal'] - _stats['total_deposit_withdrawal']) > EPSILON:
             print('WARNING! 资金状况出入金(%.2f)与出入金明细不匹配(%.2f)！' 
                 % (stats['total_deposit_withdrawal'], _stats['total_deposit_withdrawal']))
@@ -81,23 +184,75 @@ def extract_data(filepath):
     return stats
 
 
-def process_head(content):
+def load_dialects(path):
+    """
+    解析期货公司方言配置，将表头识别和出入金分类规则分别预编译为单个正则表达式
+    """
+    import yaml
+    with open(path, 'r', encoding='utf-8') as f:
+        conf = yaml.load(f, Loader=yaml.FullLoader)
+    default = conf.get('default', {})
+    headers = []
+    dialects = {}
+    for company, broker in conf['brokers'].items():
+        rules = default.get('dw_rules', []) + broker.get('dw_rules', [])
+        # 后出现的规则优先：倒序排列为多个前瞻分支，首个命中的分支即为结果
+        dw_matcher = re.compile('|'.join(
+            '(?=.*?(?:%s))(?P<r%d>)' % (rules[i]['pattern'], i) for i in reversed(range(len(rules)))
+        )) if len(rules) > 0 else None
+        dialects[company] = {
+            'labels': {**default.get('labels', {}), **broker.get('labels', {})},
+            'dw_types': [rule['dw_type'] for rule in rules],
+            'dw_matcher': dw_matcher,
+        }
+        headers += [(company, keyword) for keyword in broker.get('header', [company])]
+    header_matcher = re.compile('|'.join(
+        '(?P<h%d>%s)' % (i, re.escape(keyword)) for i, (_, keyword) in enumerate(headers)
+    ))
+    registry = {
+        'header_matcher': header_matcher,
+        'header_companies': [company for company, _ in headers],
+        'dialects': dialects,
+    }
+    return registry
+
+
+def match_company(content, registry):
+    """
+    根据结算单表头识别期货公司，无法识别时返回None
+    """
+    for line in content:
+        match = registry['header_matcher'].search(line)
+        if match is not None:
+            return registry['header_companies'][int(match.lastgroup[1:])]
+    return None
+
+
+def classify_dw(comment, dw_type, dialect):
+    """
+    根据备注对出入金类型重新归类
+    """
+    if dialect['dw_matcher'] is None:
+        return dw_type
+    match = dialect['dw_matcher'].match(comment)
+    if match is None:
+        return dw_type
+    return dialect['dw_types'][int(match.lastgroup[1:])]
+
+
+def process_head(content, registry):
     """
     处理结算单表头信息，获取期货公司、用户id、用户姓名以及日期
     """
+    company = match_company(content, registry)
+    if company is None:
+        raise ValueError('无法识别结算单所属期货公司，请在期货公司配置文件中添加：%s' % content[0].strip())
+    labels = registry['dialects'][company]['labels']
     for i in range(len(content)):
-        if '客户号' in content[i]:
+        if labels['client_id'] in content[i]:
             client_row = i
-        if '日期' in content[i]:
+        if labels['date'] in content[i]:
             date_row = i
-    if '国投安信' in content[0]:
-        company = '国投安信'
-    elif '兴证期货' in content[0]:
-        company = '兴证期货'
-    elif '方正中期' in content[0]:
-        company = '方正中期'
-    else:
-        company = ''
     client_id = content[client_row].split('：')[1].strip().split()[0]
     client_name = content[client_row].split('：')[2].strip()
     date = content[date_row].split('：')[-1].strip()
@@ -152,7 +307,7 @@ def process_summary(content):
     return stats
 
 
-def process_deposit_withdrawal(content, company):
+def process_deposit_withdrawal(content, dialect):
     """
     处理出入金，获取各笔出入金类型与金额。
     """
@@ -162,19 +317,7 @@ def process_deposit_withdrawal(content, company):
         if len(content[i].strip()) == 0:  # skip empty row
             continue
         date, dw_type, deposit, withdrawal, comment  = content[i][1:-2].split('|')
-        comment = comment.strip()
-        if '中金所申报费' in comment:
-            dw_type = '中金所申报费'
-        if '手续费减收' in comment:
-            dw_type = '手续费返还'
-        if '利息' in comment:
-            dw_type = '利息返还'
-        if len(comment) == 0 and company == '国投安信':
-            dw_type = '银期转账'
-        if '上海招行' in comment and company == '兴证期货':
-            dw_type = '银期转账'
-        if '手续费抵免' in comment and company == '方正中期':
-            dw_type = '手续费返还'
+        dw_type = classify_dw(comment.strip(), dw_type, dialect)
         dw_array.append({
             'date': date.strip(),
             'dw_type': dw_type.strip(),
@@ -235,6 +378,7 @@ def parse_rebate_conf(path):
     """
     解析手续费返还配置文件
     """
+    import pandas as pd
     conf_df = pd.read_csv(path)
     rebate_conf = []
     for i in range(len(conf_df)):
@@ -255,11 +399,36 @@ def parse_rebate_conf(path):
     return rebate_df
 
 
+def load_client_summary(path):
+    """
+    读取CTP2Excel生成的账户结算汇总表（去除合计行）
+    """
+    import pandas as pd
+    client_df = pd.read_excel(path, sheet_name='结算汇总')
+    client_df['日期'] = client_df['日期'].astype(str)
+    client_df = client_df[client_df['日期'] != '合计']
+    client_df = client_df.sort_values(by='日期').reset_index(drop=True)
+    return client_df
+
+
+def calc_rebate(client_df, rebate_df):
+    """
+    按返还配置计算每日即时手续费返还
+    """
+    comm = client_df[[col for _, col in REBATE]].values
+    rates = rebate_df.loc[client_df['日期'].values, [exchange for exchange, _ in REBATE]].values
+    return -(comm * rates).sum(axis=1)
+
+
 if __name__ == "__main__":
+    from docopt import docopt
     argv = docopt(__doc__)
+    import numpy as np
+    import pandas as pd
     CTP_files = argv['<CTP-file>']
     rebate_file = argv['--rebate-file']
     rebate_df = parse_rebate_conf(rebate_file)
+    registry = load_dialects(argv['--broker-conf'])
     start_date = datetime.strptime(argv['--start-date'], '%Y%m%d')
     if argv['--end-date'] == 'NOW':
         end_date = datetime.now()
@@ -277,6 +446,7 @@ if __name__ == "__main__":
             else:
                 print('无法找到默认的TOKEN文件！')
                 sys.exit()
+        import tushare as ts
         ts.set_token(tk)
         pro = ts.pro_api()
         cal_df = pro.trade_cal(
@@ -288,38 +458,107 @@ if __name__ == "__main__":
     else:
         cal_df = pd.read_csv(td)
     trading_dates = list(map(str, cal_df['cal_date'].values))
+    encoding = None if argv['--encoding'] == 'auto' else argv['--encoding']
     all_stats = []
     all_dates = []
-    
-    # 移除不在指定日期范围内的CTP文件（根据文件名）
-    CTP_files = [CTP_file for CTP_file in CTP_files 
-        if start_date <= datetime.strptime(os.path.basename(CTP_file).split('.')[0].split('_')[-1], '%Y%m%d') <= end_date]
+    n_failed = 0
+
+    def file_date(fpath):
+        try:
+            return datetime.strptime(os.path.basename(fpath).split('.')[0].split('_')[-1], '%Y%m%d')
+        except ValueError:  # 多日结算单文件名不含单一日期
+            return None
+
+    def out_of_range(fpath):
+        if file_date(fpath) is None or start_date <= file_date(fpath) <= end_date:
+            return False
+        # 文件名日期仅对单日结算单文件有效，多日结算单（如月度导出）按结算单日期筛选
+        try:
+            return count_statements(fpath, registry, encoding) <= 1
+        except Exception:  # 无法读取的文件留待后续隔离并记录
+            return False
+
+    # 移除不在指定日期范围内的单日CTP文件（根据文件名）
+    CTP_files = [CTP_file for CTP_file in CTP_files if not out_of_range(CTP_file)]
     if len(CTP_files) == 0:
         print('指定日期内无CTP文件，跳过。')
         sys.exit()
 
-    CTP_files.sort(key=lambda fpath: datetime.strptime(os.path.basename(fpath).split('.')[0].split('_')[-1], '%Y%m%d'))
+    CTP_files.sort(key=lambda fpath: file_date(fpath) or datetime.min)
+    output_dir = argv['--output']
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    journal_file = os.path.join(output_dir, JOURNAL_FILE)
+    quarantine_file = os.path.join(output_dir, QUARANTINE_FILE)
+    journal = load_journal(journal_file) if argv['--resume'] else {}
+    # 非续跑时重置日志，续跑时仅保留各文件的最新记录
+    compact_journal(journal_file, journal)
+    compact_journal(quarantine_file, load_journal(quarantine_file) if argv['--resume'] else {})
+    # 解析结果还取决于期货公司配置与编码，二者变化时不复用上次结果
+    conf_signature = file_signature(argv['--broker-conf']) + [argv['--encoding']]
     print('正在处理CTP文件（共%d个文件）...' % len(CTP_files))
     for i, CTP_file in enumerate(CTP_files):
         print('处理第%d个CTP文件： %s' % (i, CTP_file))
-        stats = extract_data(CTP_file)
-        if stats['date'] in all_dates:
-            print('跳过重复的CTP文件：%s' % CTP_file)
-            continue
-        all_dates.append(stats['date'])
-        all_stats.append(stats)
-    # 处理指定日期范围内完全无交易的情况
-    if len(all_stats) == 0:
-        all_stats.append(stats)
+        key = os.path.abspath(CTP_file)
+        signature = file_signature(CTP_file) + conf_signature
+        record = journal.get(key)
+        if record is not None and record['status'] == 'ok' and record['signature'] == signature:  # 复用上次运行结果
+            file_stats = record['stats']
+            for j in record.get('failed', []):  # 上次运行中隔离的结算单
+                print('WARNING! 跳过已隔离的结算单：%s（第%d个结算单）' % (CTP_file, j))
+                n_failed += 1
+        else:
+            file_stats = []
+            failed = []
+            file_failed = 0
+            try:
+                statements = read_statements(CTP_file, registry, encoding)
+                for j, contents in enumerate(statements):
+                    try:
+                        file_stats.append(extract_statement(contents, registry))
+                    except Exception as e:  # 隔离无法解析的结算单，继续处理其余结算单
+                        record = error_record('%s#%d' % (key, j), signature, e)
+                        append_journal(quarantine_file, record)
+                        print('WARNING! 第%d个结算单解析失败，已隔离：%s（%s: %s）'
+                              % (j, CTP_file, record['error'], record['message']))
+                        failed.append(j)
+                        file_failed += 1
+            except Exception as e:  # 隔离无法读取的CTP文件，继续处理其余文件
+                record = error_record(key, signature, e)
+                append_journal(quarantine_file, record)
+                print('WARNING! CTP文件读取失败，已隔离：%s（%s: %s）' % (CTP_file, record['error'], record['message']))
+                file_failed += 1
+                file_stats = []
+            n_failed += file_failed
+            if len(file_stats) == 0 and file_failed > 0:
+                append_journal(journal_file, {**record, 'key': key})
+                continue
+            append_journal(journal_file, {
+                'key': key,
+                'signature': signature,
+                'status': 'ok',
+                'stats': file_stats,
+                'failed': failed,
+            })
+        for stats in file_stats:
+            if not start_date <= datetime.strptime(stats['date'], '%Y%m%d') <= end_date:
+                continue
+            if stats['date'] in all_dates:
+                print('跳过重复的结算单：%s（%s）' % (CTP_file, stats['date']))
+                continue
+            all_dates.append(stats['date'])
+            all_stats.append(stats)
+    if n_failed > 0:
+        print('WARNING! 共%d个结算单已隔离，未计入结算表，详见%s' % (n_failed, quarantine_file))
+    if len(all_dates) == 0:
+        print('WARNING! 指定日期内无可用结算单，跳过。')
+        sys.exit(1 if n_failed > 0 else 0)
     client_ids = np.unique([stats['client_id'] for stats in all_stats])
     if len(client_ids) > 1:
         print('WARNING! 发现超过1个账号结算单，仅处理%s账号文件' % client_ids[0])
     client_id = client_ids[0]
 
     # 数据汇总输出到Excel文件中
-    output_dir = argv['--output']
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
     client_stats =[stats for stats in all_stats if stats['client_id'] == client_id]
     client = '%s-%s' % (client_stats[0]['client_id'], client_stats[0]['client_name'])
     client_data = []
@@ -373,7 +612,7 @@ if __name__ == "__main__":
         client_df['银期出入金'] + client_df['手续费返还'] + client_df['利息返还'] + client_df['中金所申报费'] - client_df['出入金合计']
         ).abs() > EPSILON
     )
-    client_df.to_csv('client.csv')
+    client_df.to_csv(os.path.join(output_dir, 'client.csv'))  # 写入输出目录，避免并行处理多个账号时相互覆盖
     if bug_rows.sum() > 0:
         print('WARNING! 出入金不匹配，请检查下列日期出入金数据：\n %s' % str(client_df[bug_rows]))
     # 检查期初结存 + 当期总流水 与 期末结存
@@ -390,17 +629,7 @@ if __name__ == "__main__":
         print('WARNING！期末结存与下期初结存不匹配，请检查下列日期数据：\n %s' % str(client_df.iloc[bug_rows]))
     # 计算盈亏
     total_pl1 = client_df['期末结存'] - client_df['期初结存'] - client_df['银期出入金']  # 当期实际盈亏
-    calc_rebate = []
-    for i in range(len(client_df)):
-        _date = client_df.iloc[i]['日期']
-        _calc_rebate = - client_df['中金所手续费'][i] * rebate_df.loc[_date, 'CFFEX'] \
-            - client_df['上期原油手续费'][i] * rebate_df.loc[_date, 'INE'] \
-            - client_df['上期所手续费'][i] * rebate_df.loc[_date, 'SHFE'] \
-            - client_df['郑商所手续费'][i] * rebate_df.loc[_date, 'CZCE'] \
-            - client_df['大商所工业品手续费'][i] * rebate_df.loc[_date, 'DCE_IND'] \
-            - client_df['大商所农产品手续费'][i] * rebate_df.loc[_date, 'DCE_AGR']
-        calc_rebate.append(_calc_rebate)
-    client_df['即时手续费返还'] = calc_rebate
+    client_df['即时手续费返还'] = calc_rebate(client_df, rebate_df)
     total_pl2 = total_pl1 - client_df['手续费返还'] + client_df['即时手续费返还'] # 当期即时盈亏
     client_df['实际盈亏'] = total_pl1
     client_df['即时盈亏'] = total_pl2
@@ -532,7 +761,14 @@ if __name__ == "__main__":
                 max_width = client_df[col].apply(lambda x: len(str(x))).max()
                 max_width = max(max_width, len(col))
                 worksheet.set_column(i, i, max_width+1)
+    # 业绩分析
+    from NAVAnalytics import write_analytics
+    write_analytics(writer, client_df[client_df['日期'] != '合计'])
     # 作图
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
     plot_path = os.path.join(
         output_dir, '%s_%s_%s.png'
         % (client, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
@@ -566,3 +802,5 @@ if __name__ == "__main__":
         )
     writer.save()
     print('%s --> %s' % (client, output_path))
+    if n_failed > 0:  # 隔离的结算单缺失导致净值失真，以单独的退出码告知调用方
+        sys.exit(PARTIAL_EXIT)
@@ -13,98 +13,248 @@ Options:
     --ext=<extension>       Specify extension of CTP files [default: csv].
     --TK=<TOKEN>            Specify tushare-token for trading calendar [default: xxli].
     --rebate-file=<FILE>    Specify rebate configuration file [default: rebate.csv].
+    --broker-conf=<FILE>    Specify broker dialect configuration file [default: brokers.yml].
+    --encoding=<ENC>        Specify encoding of CTP files, e.g. gbk, gb18030 or utf-8 [default: auto].
     --email-conf=<FILE>     Specify email configuration file [default: email.yml].
+    --resume                Skip accounts completed by a previous run and resume unfinished ones.
+    -j --jobs=<N>           Specify number of accounts processed concurrently [default: 4].
 """
 
 
-from docopt import docopt
 import os
 import sys
+import asyncio
+import tarfile
 from glob import glob
-import subprocess
-import pandas as pd
-import tushare as ts
 from datetime import datetime
-import yaml
+from journal import file_signature, load_journal, append_journal, compact_journal, error_record
+from CTP2Excel import QUARANTINE_FILE, PARTIAL_EXIT, load_dialects, match_company, read_statements
+# pandas、yaml、tushare等较重的依赖在使用处导入，以缩短启动时间
 
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 TD_FILE = 'td.csv'  # trading dates csv file
+CHECKPOINT_FILE = 'checkpoint.jsonl'  # account progress journal
 COLUMNS = ('日期', '期初结存', '银期出入金', '手续费返还', '利息返还', '中金所申报费', '出入金合计', '平仓盈亏', '盯市盈亏', 
            '手续费', '交割手续费', '中金所手续费', '上期原油手续费', '上期所手续费', '郑商所手续费', '大商所工业品手续费', '大商所农产品手续费', '期末结存',
            '实际盈亏', '实际份额', '实际净值', '即时手续费返还', '即时期末结存', '即时盈亏', '即时份额', '即时净值') # 结算总表
 
 
-if __name__ == "__main__":
-    argv = docopt(__doc__)
-    raw_dir = argv['<RAW-DIR>']
-    ext = argv['--ext']
-    output_dir = argv['--output']
-    start_date = argv['--start-date']
-    end_date = argv['--end-date']
-    tk = argv['--TK']
-    if argv['--end-date'] == 'NOW':
-        end_date = datetime.now().strftime('%Y%m%d')
-    print('设定起始日期为%s，结束日期为%s' % (start_date, end_date))
-    # 获取交易日历
-    if tk == 'xxli':
-        if os.path.exists('./tk.csv'):
-            with open('./tk.csv', 'r') as f:
-                contents = f.readlines()
-            tk = contents[1].strip()
-        else:
-            print('无法找到默认的TOKEN文件！')
-            sys.exit()
+def fetch_calendar(tk, start_date, end_date):
+    """
+    从tushare获取交易日历并写入TD文件
+    """
+    import tushare as ts
     ts.set_token(tk)
     pro = ts.pro_api()
     cal_df = pro.trade_cal(exchange='', start_date=start_date, end_date=end_date)
     cal_df = cal_df[cal_df['is_open'] == 1]
     cal_df.to_csv(TD_FILE, index='False')
-    print('从%s获取原始CTP文件并将总结算单写入%s' % (raw_dir, output_dir))
-    print('=' * 80)
+
+
+def scan_accounts(raw_dir, ext, confs, registry, encoding):
+    """
+    遍历<RAW-DIR>/期货公司/账号目录，逐个返回账号及其结算单文件与签名；
+    读取首个结算单的表头识别期货公司，以便在处理前提示未配置的期货公司
+    """
     companies = next(os.walk(raw_dir))[1]
     for i, company in enumerate(companies):
-        print('%d: 处理%s期货公司数据' % (i, company))
         clients = next(os.walk(os.path.join(raw_dir, company)))[1]
         for j, client in enumerate(clients):
-            print('%d.%d: 处理%s账号数据' % (i, j, client))
             raw_files = glob('%s/%s/%s/*.%s' % (raw_dir, company, client, ext))
-            if len(raw_files) == 0:
-                print('WARNING! 未找到%s内的结算单文件，请检查文件后缀以及文件目录结构是否符合标准！' % company)
-                continue
-            task_dir = os.path.join(output_dir, company, client)
-            res = subprocess.run([
-                'python', '%s/CTP2Excel.py' % BASE_PATH,
-                '-o', task_dir,
-                '--start-date', start_date,
-                '--end-date', end_date,
-                '--TD', TD_FILE,
-                '--TK', tk,
-                '--rebate-file', argv['--rebate-file'],
-                ] + raw_files,
-                capture_output=True
-            )
-            print(res.stdout.decode('utf-8'), res.stderr.decode('utf-8'))
-            print('-' * 80)
-    
-    # 生成汇总报表
-    client_files = glob('%s/*/*/*_%s_%s.xlsx' % (output_dir, start_date, end_date))
-    if len(client_files) == 0:
-        print('WARNING! 未发现任何结算文件，无法生成汇总报表！！！')
-        sys.exit()
-
-    client_data = []
-    bf_data = []
-    for client_file in client_files:
-        data = pd.read_excel(client_file, sheet_name=None)
-        if '结算汇总' in data:
-            _data = data['结算汇总'].set_index('日期')
-            _data.index = _data.index.astype(str)
-            client_data.append(_data)
-        if '银期转账' in data:
-            _data = data['银期转账'].set_index('日期')
-            _data.index = _data.index.astype(str)
-            bf_data.append(_data)
+            broker = None
+            if len(raw_files) > 0:
+                try:
+                    broker = match_company(next(read_statements(raw_files[0], registry, encoding), []), registry)
+                except (ValueError, LookupError):  # 编码无法识别等错误留待处理阶段隔离并记录
+                    pass
+            account = {
+                'label': '%d.%d' % (i, j),
+                'company': company,
+                'client': client,
+                'key': '%s/%s' % (company, client),
+                'broker': broker,
+                'raw_files': raw_files,
+                'signature': {
+                    'files': sorted([[os.path.basename(raw_file)] + file_signature(raw_file) for raw_file in raw_files]),
+                    'confs': confs,
+                },
+            }
+            yield account
+
+
+async def discover(raw_dir, ext, confs, registry, encoding, accounts, n_workers):
+    """
+    发现阶段：在线程池中遍历目录，每发现一个账号即放入队列
+    """
+    loop = asyncio.get_running_loop()
+    scanner = scan_accounts(raw_dir, ext, confs, registry, encoding)
+    while True:
+        account = await loop.run_in_executor(None, next, scanner, None)
+        if account is None:
+            break
+        if len(account['raw_files']) > 0 and account['broker'] is None:
+            print('%s: WARNING! 无法识别%s账号结算单所属期货公司，请在期货公司配置文件中添加！\n%s'
+                  % (account['label'], account['key'], '-' * 80))
+        await accounts.put(account)
+    for _ in range(n_workers):
+        await accounts.put(None)
+
+
+def count_quarantined(task_dir, raw_files, argv):
+    """
+    统计账号当前仍处于隔离状态的结算单数量，仅计入与当前文件及配置签名一致的隔离记录
+    """
+    conf_signature = file_signature(argv['--broker-conf']) + [argv['--encoding']]
+    signatures = {os.path.abspath(raw_file): file_signature(raw_file) + conf_signature for raw_file in raw_files}
+    n_quarantined = 0
+    for key, record in load_journal(os.path.join(task_dir, QUARANTINE_FILE)).items():
+        path = key if key in signatures else key.rsplit('#', 1)[0]  # 结算单记录的key为<文件>#<序号>
+        if signatures.get(path) == record['signature']:
+            n_quarantined += 1
+    return n_quarantined
+
+
+async def process(accounts, results, calendar, checkpoint, tk, argv):
+    """
+    处理阶段：交易日历就绪后，以子进程运行CTP2Excel处理账号，完成后立即交给汇总阶段
+    """
+    output_dir = argv['--output']
+    start_date, end_date = argv['--start-date'], argv['--end-date']
+    checkpoint_file = os.path.join(output_dir, CHECKPOINT_FILE)
+    while True:
+        account = await accounts.get()
+        if account is None:
+            break
+        company, client, key = account['company'], account['client'], account['key']
+        raw_files = account['raw_files']
+        signature = {**account['signature'], 'start_date': start_date, 'end_date': end_date}
+        if len(raw_files) == 0:
+            print('%s: %s账号\nWARNING! 未找到%s内的结算单文件，请检查文件后缀以及文件目录结构是否符合标准！\n%s'
+                  % (account['label'], client, company, '-' * 80))
+            continue
+        record = checkpoint.get(key)
+        if record is not None and record['status'] == 'ok' and record['signature'] == signature \
+                and all([os.path.exists(output_file) for output_file in record['outputs']]):
+            print('%s: %s账号已在上次运行中完成，跳过。\n%s' % (account['label'], client, '-' * 80))
+            await results.put({**account, 'status': 'ok', 'outputs': record['outputs']})
+            continue
+        await calendar
+        task_dir = os.path.join(output_dir, company, client)
+        proc = await asyncio.create_subprocess_exec(
+            'python', '%s/CTP2Excel.py' % BASE_PATH,
+            '-o', task_dir,
+            '--start-date', start_date,
+            '--end-date', end_date,
+            '--TD', TD_FILE,
+            '--TK', tk,
+            '--rebate-file', argv['--rebate-file'],
+            '--broker-conf', argv['--broker-conf'],
+            '--encoding', argv['--encoding'],
+            *(['--resume'] if argv['--resume'] else []),
+            *raw_files,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        print('%s: 处理%s期货公司%s账号数据\n%s %s'
+              % (account['label'], company, client, stdout.decode('utf-8'), stderr.decode('utf-8')))
+        if proc.returncode not in (0, PARTIAL_EXIT):
+            print('WARNING! %s账号处理失败，不计入汇总报表！' % client)
+            append_journal(checkpoint_file, {
+                'key': key,
+                'signature': signature,
+                'status': 'error',
+                'returncode': proc.returncode,
+                'message': stderr.decode('utf-8')[-2000:],
+            })
+            await results.put({**account, 'status': 'error', 'outputs': []})
+        else:
+            outputs = glob('%s/*_%s_%s.xlsx' % (task_dir, start_date, end_date))
+            record = {'key': key, 'signature': signature, 'status': 'ok', 'outputs': outputs}
+            if proc.returncode == PARTIAL_EXIT:  # 部分结算单被隔离，续跑时需重新处理
+                record['status'] = 'partial'
+                record['quarantined'] = count_quarantined(task_dir, raw_files, argv)
+                print('WARNING! %s账号共%d个结算单已隔离，该账号净值可能失真！' % (client, record['quarantined']))
+            append_journal(checkpoint_file, record)
+            await results.put({**account, **record})
+        print('-' * 80)
+    await results.put(None)  # 通知汇总阶段该处理协程已结束
+
+
+def load_client_file(client_file):
+    """
+    读取单个账号的结算汇总与银期转账表
+    """
+    import pandas as pd
+    data = pd.read_excel(client_file, sheet_name=None)
+    client_data, bf_data = None, None
+    if '结算汇总' in data:
+        client_data = data['结算汇总'].set_index('日期')
+        client_data.index = client_data.index.astype(str)
+    if '银期转账' in data:
+        bf_data = data['银期转账'].set_index('日期')
+        bf_data.index = bf_data.index.astype(str)
+    return client_data, bf_data
+
+
+async def collect(results, archive, checkpoint_file, n_workers):
+    """
+    汇总阶段：每个账号完成后立即读取其结算文件并加入归档，返回各账号结果；
+    读取失败的账号标记为失败并记入日志，续跑时重新处理
+    """
+    loop = asyncio.get_running_loop()
+    finished = []
+    while n_workers > 0:
+        result = await results.get()
+        if result is None:
+            n_workers -= 1
+            continue
+        result['data'] = []
+        try:
+            for client_file in result['outputs']:
+                result['data'].append(await loop.run_in_executor(None, load_client_file, client_file))
+                if archive is not None:
+                    await loop.run_in_executor(None, archive.add, client_file)
+        except Exception as e:
+            print('WARNING! 读取%s账号结算文件失败，不计入汇总报表！(%s)' % (result['client'], e))
+            append_journal(checkpoint_file, error_record(result['key'], result['signature'], e))
+            result['status'], result['data'] = 'error', []
+        finished.append(result)
+    return finished
+
+
+async def run_pipeline(argv, tk, archive):
+    """
+    交易日历获取与目录发现并行，账号处理与汇总读取流水线执行
+    """
+    loop = asyncio.get_running_loop()
+    n_workers = int(argv['--jobs'])
+    checkpoint_file = os.path.join(argv['--output'], CHECKPOINT_FILE)
+    checkpoint = load_journal(checkpoint_file) if argv['--resume'] else {}
+    compact_journal(checkpoint_file, checkpoint)  # 非续跑时重置日志，续跑时仅保留各账号的最新记录
+    confs = [file_signature(conf) for conf in (argv['--rebate-file'], argv['--broker-conf'])] + [argv['--encoding']]
+    registry = load_dialects(argv['--broker-conf'])
+    encoding = None if argv['--encoding'] == 'auto' else argv['--encoding']
+    accounts = asyncio.Queue(maxsize=2 * n_workers)
+    results = asyncio.Queue(maxsize=2 * n_workers)
+    calendar = loop.run_in_executor(None, fetch_calendar, tk, argv['--start-date'], argv['--end-date'])
+    # 汇总阶段与其余阶段一同等待，任一阶段出错即抛出，避免队列阻塞导致挂起
+    *_, finished = await asyncio.gather(
+        discover(argv['<RAW-DIR>'], argv['--ext'], confs, registry, encoding, accounts, n_workers),
+        *[process(accounts, results, calendar, checkpoint, tk, argv) for _ in range(n_workers)],
+        collect(results, archive, checkpoint_file, n_workers),
+    )
+    await calendar  # 全部账号均跳过时仍需确认交易日历获取成功
+    return sorted(finished, key=lambda result: result['key'])
+
+
+def write_summary(client_data, bf_data, output_dir, start_date, end_date):
+    """
+    生成所有账号的结算总表
+    """
+    import pandas as pd
+    from NAVAnalytics import write_analytics
     # 结算汇总
     dates = sorted(list(set(
         [date for i in range(len(client_data)) for date in client_data[i].index.values[:-1].tolist()]
@@ -181,52 +331,107 @@ if __name__ == "__main__":
                     max_width = max(max_width, len(col))
                     worksheet.set_column(i, i, max_width+1)
     bf_df.to_excel(writer, '银期转账', index=False, columns=('日期', '入金', '出金'))
+    write_analytics(writer, client_df[client_df['日期'] != '合计'])
     writer.save()
+    return final_summary
+
+
+def send_email(email_conf, archive_file):
+    """
+    发送结算文件归档邮件
+    """
+    import smtplib
+    import mimetypes
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.base import MIMEBase
+    from email.utils import COMMASPACE, formatdate
+    from email.header import Header
+    from email import encoders
+
+    outer  = MIMEMultipart()
+    outer ['From'] = email_conf['sender']['account']
+    outer ['To'] = COMMASPACE.join(email_conf['recipients'])
+    outer ['Date'] = formatdate(localtime=True)
+    outer ['Subject'] = Header('结算表', 'utf-8')
+
+    ctype, encoding = mimetypes.guess_type(archive_file)
+    if ctype is None or encoding is not None:
+        ctype = 'application/octet-stream'
+    maintype, subtype = ctype.split('/', 1)
+    with open(archive_file, 'rb') as fp:
+        msg = MIMEBase(maintype, subtype)
+        msg.set_payload(fp.read())
+        encoders.encode_base64(msg)
+    msg.add_header('Content-Disposition', 'attachment', filename=os.path.basename(archive_file))
+    outer.attach(msg)
+
+    try:
+        server = smtplib.SMTP(email_conf['server'])
+        server.login(email_conf['sender']['account'], email_conf['sender']['passwd'])
+        server.sendmail(email_conf['sender']['account'], email_conf['recipients'], outer.as_string())
+        server.quit()
+        print('邮件发送成功！')
+    except:
+        print('邮件发送失败！')
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    argv = docopt(__doc__)
+    raw_dir = argv['<RAW-DIR>']
+    output_dir = argv['--output']
+    start_date = argv['--start-date']
+    end_date = argv['--end-date']
+    tk = argv['--TK']
+    if argv['--end-date'] == 'NOW':
+        end_date = datetime.now().strftime('%Y%m%d')
+        argv['--end-date'] = end_date
+    print('设定起始日期为%s，结束日期为%s' % (start_date, end_date))
+    if tk == 'xxli':
+        if os.path.exists('./tk.csv'):
+            with open('./tk.csv', 'r') as f:
+                contents = f.readlines()
+            tk = contents[1].strip()
+        else:
+            print('无法找到默认的TOKEN文件！')
+            sys.exit()
+    print('从%s获取原始CTP文件并将总结算单写入%s' % (raw_dir, output_dir))
     print('=' * 80)
-    print('总结算单已写入%s' % final_summary)
-    # 发送邮件
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    import yaml
     email_conf = yaml.load(open(argv['--email-conf'], 'r'), Loader=yaml.FullLoader)
-    if email_conf['send_email']:
-        result_files = glob('%s/*/*/*_%s_%s.xlsx' % (output_dir, start_date, end_date))
-        result_files += glob('%s/*_%s_%s.xlsx' % (output_dir, start_date, end_date))
-        archive_file = '%s_%s.tar' % (start_date, end_date)
-        res = subprocess.run([
-            'tar', '-cvf', archive_file,
-            ] + result_files,
-            capture_output=True
-        )
+    # 需要发送邮件时，各账号结算文件在完成后即加入归档
+    archive_file = '%s_%s.tar' % (start_date, end_date)
+    archive = tarfile.open(archive_file, 'w') if email_conf['send_email'] else None
+    # 获取交易日历、发现账号、处理账号与读取结算文件以流水线方式并行执行
+    try:
+        finished = asyncio.run(run_pipeline(argv, tk, archive))
+        failed_accounts = [result['key'] for result in finished if result['status'] == 'error']
+        if len(failed_accounts) > 0:
+            print('WARNING! 以下账号处理失败，详见%s：\n %s'
+                  % (os.path.join(output_dir, CHECKPOINT_FILE), '\n '.join(failed_accounts)))
+        partial_accounts = ['%s（%d个结算单已隔离）' % (result['key'], result['quarantined'])
+                            for result in finished if result['status'] == 'partial']
+        if len(partial_accounts) > 0:
+            print('WARNING! 以下账号部分结算单已隔离，计入汇总报表的净值可能失真，续跑时将重新处理：\n %s'
+                  % '\n '.join(partial_accounts))
 
-        import smtplib
-        import mimetypes
-        from email.mime.application import MIMEApplication
-        from email.mime.multipart import MIMEMultipart
-        from email.mime.base import MIMEBase
-        from email.utils import COMMASPACE, formatdate
-        from email.header import Header
-        from email import encoders
-
-        outer  = MIMEMultipart()
-        outer ['From'] = email_conf['sender']['account']
-        outer ['To'] = COMMASPACE.join(email_conf['recipients'])
-        outer ['Date'] = formatdate(localtime=True)
-        outer ['Subject'] = Header('结算表', 'utf-8')
-
-        ctype, encoding = mimetypes.guess_type(archive_file)
-        if ctype is None or encoding is not None:
-            ctype = 'application/octet-stream'
-        maintype, subtype = ctype.split('/', 1)
-        with open(archive_file, 'rb') as fp:
-            msg = MIMEBase(maintype, subtype)
-            msg.set_payload(fp.read())
-            encoders.encode_base64(msg)
-        msg.add_header('Content-Disposition', 'attachment', filename=os.path.basename(archive_file))
-        outer.attach(msg)
-
-        try:
-            server = smtplib.SMTP(email_conf['server'])
-            server.login(email_conf['sender']['account'], email_conf['sender']['passwd'])
-            server.sendmail(email_conf['sender']['account'], email_conf['recipients'], outer.as_string())
-            server.quit()
-            print('邮件发送成功！')
-        except:
-            print('邮件发送失败！')
+        # 生成汇总报表
+        client_data = [data for result in finished for data, _ in result['data'] if data is not None]
+        bf_data = [data for result in finished for _, data in result['data'] if data is not None]
+        if len(client_data) == 0:
+            print('WARNING! 未发现任何结算文件，无法生成汇总报表！！！')
+            sys.exit()
+        final_summary = write_summary(client_data, bf_data, output_dir, start_date, end_date)
+        print('=' * 80)
+        print('总结算单已写入%s' % final_summary)
+        if archive is not None:
+            archive.add(final_summary)
+    finally:
+        if archive is not None:
+            archive.close()
+    # 发送邮件
+    if archive is not None:
+        send_email(email_conf, archive_file)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""Rolling performance analytics on the NAV columns of CTP2Excel summaries.
+
+Usage:
+    NAVAnalytics.py <client-file>... [options]
+
+Options:
+    -h --help               Show this screen.
+    -o --output=<folder>    Specify output directory [default: output].
+    -w --window=<DAYS>      Specify rolling window in trading days [default: 20].
+    --state=<FILE>          Specify state file for incremental updates [default: analytics_state.json].
+    --full                  Recompute all dates instead of only the days appended since the last run.
+"""
+
+
+import numpy as np
+import pandas as pd
+import os
+import json
+from math import sqrt
+
+
+NAV_FIELDS = ('实际净值', '即时净值')
+TRADING_DAYS = 252  # 年化交易日数
+RISK_FREE = 0.  # 年化无风险利率
+EPSILON = 0.001  # 净值清零判断阈值
+DAILY_COLUMNS = ('日期', '净值', '日收益率', '累计收益率', '最高净值', '回撤', '最大回撤', '回撤天数', '滚动波动率')
+
+
+def nav_returns(nav):
+    """
+    计算日收益率；净值清零或重新起算的日期收益率记为0
+    """
+    nav = np.asarray(nav, dtype=float)
+    returns = np.zeros(len(nav))
+    valid = (nav[:-1] > EPSILON) & (nav[1:] > EPSILON)
+    returns[1:][valid] = nav[1:][valid] / nav[:-1][valid] - 1.
+    return returns
+
+
+def nav_analytics(dates, nav, window=20):
+    """
+    计算每日收益率、累计收益率、回撤、最大回撤、回撤天数和滚动年化波动率
+    """
+    returns = nav_returns(nav)
+    index = np.cumprod(1. + returns)  # 链接净值，跨越清零重启保持连续
+    peak = np.maximum.accumulate(index)
+    drawdown = index / peak - 1.
+    steps = np.arange(len(index))
+    peak_step = np.maximum.accumulate(np.where(index >= peak, steps, 0))
+    # 滚动波动率：基于累计和的窗口差分，窗口不含首个有效净值及之前补齐行的收益率
+    valid = np.where(np.asarray(nav, dtype=float) > EPSILON)[0]
+    start = valid[0] if len(valid) > 0 else len(nav)
+    csum = np.cumsum(np.r_[0., returns])
+    csum2 = np.cumsum(np.r_[0., returns ** 2])
+    lower = np.minimum(np.maximum(steps + 1 - window, start + 1), steps + 1)
+    count = steps + 1 - lower
+    total = csum[steps + 1] - csum[lower]
+    total2 = csum2[steps + 1] - csum2[lower]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = np.where(count > 1, (total2 - total ** 2 / count) / (count - 1), np.nan)
+    analytics_df = pd.DataFrame({
+        '日期': dates,
+        '净值': nav,
+        '日收益率': returns,
+        '累计收益率': index - 1.,
+        '最高净值': peak,
+        '回撤': drawdown,
+        '最大回撤': np.minimum.accumulate(drawdown),
+        '回撤天数': steps - peak_step,
+        '滚动波动率': np.sqrt(np.maximum(var, 0.) * TRADING_DAYS),
+    }, columns=DAILY_COLUMNS)
+    return analytics_df
+
+
+def monthly_returns(dates, nav):
+    """
+    计算月度收益率表（行为年份，列为月份，另附全年收益率）
+    """
+    index = pd.Series(np.cumprod(1. + nav_returns(nav)), index=pd.to_datetime(dates, format='%Y%m%d'))
+    month_end = index.groupby([index.index.year, index.index.month]).last()
+    month_ret = month_end / month_end.shift(1).fillna(1.) - 1.
+    month_df = month_ret.unstack()
+    year_end = index.groupby(index.index.year).last()
+    month_df['全年'] = year_end / year_end.shift(1).fillna(1.) - 1.
+    month_df.index.name = '年份'
+    return month_df
+
+
+def init_state(analytics_df, window=20):
+    """
+    由完整计算结果生成增量更新所需的状态
+    """
+    valid = np.where(analytics_df['净值'].values > EPSILON)[0]
+    start = valid[0] if len(valid) > 0 else len(analytics_df)
+    returns = analytics_df['日收益率'].values[start+1:]  # 首个有效净值之前的补齐行不计入
+    last_row = analytics_df.iloc[-1]
+    state = {
+        'first_date': str(analytics_df.iloc[start]['日期']) if start < len(analytics_df) else None,
+        'date': str(last_row['日期']),
+        'nav': float(last_row['净值']),
+        'index': float(last_row['累计收益率']) + 1.,
+        'peak': float(last_row['最高净值']),
+        'max_drawdown': float(last_row['最大回撤']),
+        'drawdown_days': int(last_row['回撤天数']),
+        'max_drawdown_days': int(analytics_df['回撤天数'].max()),
+        'count': len(returns),
+        'sum': float(returns.sum()),
+        'sum2': float((returns ** 2).sum()),
+        'window_returns': returns[-window:].tolist(),
+    }
+    return state
+
+
+def state_current(state, dates, nav):
+    """
+    判断状态是否仍与结算表一致：状态日期仍在结算表中，且当日净值未因补录或重算而改变
+    """
+    idx = np.where(np.asarray(dates) == state['date'])[0]
+    return len(idx) > 0 and abs(float(nav[idx[0]]) - state['nav']) < EPSILON
+
+
+def append_day(state, date, nav, window=20):
+    """
+    追加一个交易日，返回当日分析结果与更新后的状态，计算量与历史长度无关
+    """
+    ret = nav / state['nav'] - 1. if (state['nav'] > EPSILON and nav > EPSILON) else 0.
+    index = state['index'] * (1. + ret)
+    peak = max(state['peak'], index)
+    drawdown = index / peak - 1.
+    drawdown_days = 0 if index >= peak else state['drawdown_days'] + 1
+    started = state['first_date'] is not None
+    window_returns = (state['window_returns'] + [ret] * started)[-window:]
+    n = len(window_returns)
+    if n > 1:
+        mean = sum(window_returns) / n
+        vol = sqrt(max(sum([(r - mean) ** 2 for r in window_returns]) / (n - 1), 0.) * TRADING_DAYS)
+    else:
+        vol = np.nan
+    row = {
+        '日期': date,
+        '净值': nav,
+        '日收益率': ret,
+        '累计收益率': index - 1.,
+        '最高净值': peak,
+        '回撤': drawdown,
+        '最大回撤': min(state['max_drawdown'], drawdown),
+        '回撤天数': drawdown_days,
+        '滚动波动率': vol,
+    }
+    state = {
+        **state,
+        'first_date': state['first_date'] if started else (date if nav > EPSILON else None),
+        'date': date,
+        'nav': nav,
+        'index': index,
+        'peak': peak,
+        'max_drawdown': row['最大回撤'],
+        'drawdown_days': drawdown_days,
+        'max_drawdown_days': max(state['max_drawdown_days'], drawdown_days),
+        'count': state['count'] + started,
+        'sum': state['sum'] + ret,
+        'sum2': state['sum2'] + ret ** 2,
+        'window_returns': window_returns,
+    }
+    return row, state
+
+
+def summarize(state):
+    """
+    根据状态计算区间收益、年化收益、年化波动率、夏普比率、卡玛比率等指标；
+    夏普比率为日均超额收益年化（x252）除以年化波动率，卡玛比率为复合年化收益除以最大回撤
+    """
+    n = state['count']
+    annual_return = state['index'] ** (TRADING_DAYS / n) - 1. if (n > 0 and state['index'] > 0) else np.nan
+    if n > 1:
+        var = (state['sum2'] - state['sum'] ** 2 / n) / (n - 1)
+        annual_vol = sqrt(max(var, 0.) * TRADING_DAYS)
+        annual_mean = state['sum'] / n * TRADING_DAYS
+    else:
+        annual_vol = np.nan
+        annual_mean = np.nan
+    summary = {
+        '起始日期': state['first_date'],
+        '结束日期': state['date'],
+        '最新净值': state['nav'],
+        '区间收益率': state['index'] - 1.,
+        '年化收益率': annual_return,
+        '年化波动率': annual_vol,
+        '夏普比率': (annual_mean - RISK_FREE) / annual_vol if annual_vol > 0 else np.nan,
+        '最大回撤': state['max_drawdown'],
+        '卡玛比率': annual_return / -state['max_drawdown'] if state['max_drawdown'] < 0 else np.nan,
+        '当前回撤天数': state['drawdown_days'],
+        '最长回撤天数': state['max_drawdown_days'],
+    }
+    return summary
+
+
+def write_analytics(writer, client_df, window=20):
+    """
+    将实际净值与即时净值的业绩分析写入Excel：业绩指标、业绩分析（逐日）和月度收益三张表
+    """
+    dates = client_df['日期'].values
+    summary = []
+    daily = []
+    monthly = []
+    for field in NAV_FIELDS:
+        analytics_df = nav_analytics(dates, client_df[field].values, window)
+        summary.append({'净值类型': field, **summarize(init_state(analytics_df, window))})
+        daily.append(analytics_df.set_index('日期').drop(columns='净值').add_prefix(field[:2]))
+        month_df = monthly_returns(dates, client_df[field].values)
+        month_df.insert(0, '净值类型', field)
+        monthly.append(month_df)
+    pd.DataFrame(summary).to_excel(writer, '业绩指标', index=False)
+    pd.concat(daily, axis=1).to_excel(writer, '业绩分析', freeze_panes=(1, 1))
+    pd.concat(monthly).to_excel(writer, '月度收益')
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    argv = docopt(__doc__)
+    from CTP2Excel import load_client_summary  # 避免与CTP2Excel循环导入
+    output_dir = argv['--output']
+    window = int(argv['--window'])
+    state_file = argv['--state']
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    states = {}
+    if os.path.exists(state_file) and not argv['--full']:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            states = json.load(f)
+    daily_file = os.path.join(output_dir, '业绩分析.csv')
+    summary_file = os.path.join(output_dir, '业绩指标.csv')
+    if len(states) == 0 and os.path.exists(daily_file):  # 全量计算时重新生成逐日明细
+        os.remove(daily_file)
+
+    for client_file in argv['<client-file>']:
+        client_df = load_client_summary(client_file)
+        if len(client_df) == 0:
+            continue
+        client = str(client_df.iloc[0]['账户'])
+        dates = client_df['日期'].values
+        daily = []
+        recomputed = []
+        for field in NAV_FIELDS:
+            key = '%s/%s' % (client, field)
+            state = states.get(key)
+            if state is not None and not state_current(state, dates, client_df[field].values):
+                print('%s: %s历史数据已变化，重新计算全部交易日' % (client, field))
+                state = None
+            if state is not None:  # 仅处理新增交易日
+                new_rows = client_df[client_df['日期'] > state['date']]
+                rows = []
+                for date, nav in zip(new_rows['日期'].values, new_rows[field].values):
+                    row, state = append_day(state, date, float(nav), window)
+                    rows.append(row)
+                analytics_df = pd.DataFrame(rows, columns=DAILY_COLUMNS)
+            else:
+                analytics_df = nav_analytics(dates, client_df[field].values, window)
+                state = init_state(analytics_df, window)
+                recomputed.append(field)
+            states[key] = state
+            analytics_df.insert(0, '净值类型', field)
+            analytics_df.insert(0, '账户', client)
+            daily.append(analytics_df)
+        if len(recomputed) > 0 and os.path.exists(daily_file):  # 全量重算的净值先移除已写入的旧明细
+            old_df = pd.read_csv(daily_file, dtype={'账户': str, '日期': str})
+            old_df = old_df[~((old_df['账户'] == client) & old_df['净值类型'].isin(recomputed))]
+            old_df.to_csv(daily_file, index=False)
+        daily_df = pd.concat(daily)
+        daily_df.to_csv(daily_file, mode='a', index=False, header=not os.path.exists(daily_file))
+        print('%s: 新增%d行分析数据' % (client, len(daily_df)))
+    # 业绩指标包含状态文件中的全部账号，而不仅是本次传入的账号
+    summary = []
+    for key, state in sorted(states.items()):
+        client, field = key.rsplit('/', 1)
+        summary.append({'账户': client, '净值类型': field, **summarize(state)})
+    pd.DataFrame(summary).to_csv(summary_file, index=False)
+    with open(state_file, 'w', encoding='utf-8') as f:
+        json.dump(states, f, ensure_ascii=False)
+    print('业绩分析 --> %s, %s' % (daily_file, summary_file))
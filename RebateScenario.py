@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Compare instant rebate, P&L and NAV under multiple rebate schedules.
+
+Usage:
+    RebateScenario.py <client-file> <rebate-file>... [options]
+
+Options:
+    -h --help               Show this screen.
+    -o --output=<folder>    Specify output directory [default: output].
+"""
+
+
+import numpy as np
+import pandas as pd
+import os
+from CTP2Excel import REBATE, EPSILON, parse_rebate_conf, load_client_summary
+
+
+def stack_rebate_confs(rebate_dfs, dates):
+    """
+    将多个返还配置对齐到结算日期，得到 情景 x 日期 x 交易所 的返还比例矩阵
+    """
+    exchanges = [exchange for exchange, _ in REBATE]
+    rates = np.stack([
+        rebate_df.reindex(index=dates, columns=exchanges).values.astype(float) for rebate_df in rebate_dfs
+    ])
+    return rates
+
+
+def evaluate_scenarios(client_df, rates):
+    """
+    按 情景 x 日期 矩阵批量计算即时手续费返还、即时盈亏、即时期末结存和即时净值，
+    计算口径与CTP2Excel一致。
+    """
+    comm = client_df[[col for _, col in REBATE]].values
+    missing = np.isnan(rates) & (np.abs(comm) > EPSILON)[np.newaxis, :, :]
+    rates = np.nan_to_num(rates)
+    rebate = -(rates * comm[np.newaxis, :, :]).sum(axis=2)  # 即时手续费返还
+    total_pl2 = client_df['实际盈亏'].values - client_df['手续费返还'].values + rebate  # 即时盈亏
+    dw_bf = client_df['银期出入金'].values
+    balance_cf1 = client_df['期末结存'].values
+    units1 = client_df['实际份额'].values
+    value1 = client_df['实际净值'].values
+
+    n_scenarios, n_dates = rebate.shape
+    balance_cf2 = np.zeros((n_scenarios, n_dates))
+    units2 = np.zeros((n_scenarios, n_dates))
+    value2 = np.zeros((n_scenarios, n_dates))
+    # 跳过首个结算单之前的补齐行
+    valid = np.where(value1 > EPSILON)[0]
+    start = valid[0] if len(valid) > 0 else n_dates
+    if start < n_dates:
+        balance_cf2[:, start] = balance_cf1[start]
+        balance_cf2[:, start+1:] = balance_cf1[start] + np.cumsum(total_pl2[:, start+1:] + dw_bf[start+1:], axis=1)
+        units2[:, start] = balance_cf1[start]
+        value2[:, start] = 1.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(start + 1, n_dates):
+            if abs(dw_bf[i]) > EPSILON:  # 处理银期出入后份额变化
+                if value1[i-1] < EPSILON:  # 净值清零
+                    units2[:, i] = dw_bf[i] / 1.
+                    value2[:, i] = 1.
+                    continue
+                units2[:, i] = units2[:, i-1] + dw_bf[i] / value2[:, i-1]
+                if units1[i] < EPSILON:  # 份额清零
+                    value2[:, i] = 0.
+                    continue
+            else:  # 保持份额
+                units2[:, i] = units2[:, i-1]
+            value2[:, i] = balance_cf2[:, i] / units2[:, i]
+    return {
+        '即时手续费返还': rebate,
+        '即时盈亏': total_pl2,
+        '即时期末结存': balance_cf2,
+        '即时净值': value2,
+        'missing': missing.any(axis=(1, 2)),
+    }
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    argv = docopt(__doc__)
+    client_file = argv['<client-file>']
+    rebate_files = argv['<rebate-file>']
+    output_dir = argv['--output']
+    client_df = load_client_summary(client_file)
+    dates = client_df['日期'].values
+    scenarios = [os.path.splitext(os.path.basename(rebate_file))[0] for rebate_file in rebate_files]
+    if len(set(scenarios)) < len(scenarios):  # 同名配置文件使用完整路径区分
+        scenarios = rebate_files
+    print('正在评估%d个返还情景（共%d个交易日）...' % (len(scenarios), len(dates)))
+    rates = stack_rebate_confs([parse_rebate_conf(rebate_file) for rebate_file in rebate_files], dates)
+    results = evaluate_scenarios(client_df, rates)
+    for scenario in np.array(scenarios)[results['missing']]:
+        print('WARNING! 返还配置%s未覆盖全部有手续费的交易日，缺失部分按0计算' % scenario)
+
+    # 情景对比表
+    summary_df = pd.DataFrame({
+        '情景': scenarios,
+        '即时手续费返还': results['即时手续费返还'].sum(axis=1),
+        '即时盈亏': results['即时盈亏'].sum(axis=1),
+        '即时期末结存': results['即时期末结存'][:, -1],
+        '即时净值': results['即时净值'][:, -1],
+    })
+    summary_df['实际手续费返还'] = client_df['手续费返还'].sum()
+    summary_df['返还差额'] = summary_df['即时手续费返还'] - summary_df['实际手续费返还']
+    summary_df.sort_values(by='即时净值', ascending=False, inplace=True)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    output_path = os.path.join(
+        output_dir, '%s_情景对比.xlsx' % os.path.splitext(os.path.basename(client_file))[0]
+    )
+    writer = pd.ExcelWriter(output_path, engine='xlsxwriter')
+    summary_df.to_excel(writer, '情景对比', index=False, freeze_panes=(1, 1))
+    worksheet = writer.sheets['情景对比']
+    for i, col in enumerate(summary_df.columns):
+        if summary_df[col].dtype == 'float64':
+            max_width = summary_df[col].apply(lambda x: len(str('%.2f' % x))).max()
+        else:
+            max_width = summary_df[col].apply(lambda x: len(str(x))).max()
+        worksheet.set_column(i, i, max(max_width, len(col)) + 1)
+    # 各指标 日期 x 情景 明细
+    for field in ('即时手续费返还', '即时盈亏', '即时净值'):
+        pd.DataFrame(results[field].T, index=dates, columns=scenarios).to_excel(
+            writer, field, index_label='日期', freeze_panes=(1, 1)
+        )
+    writer.save()
+    print('%s --> %s' % (client_file, output_path))
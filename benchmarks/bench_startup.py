@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Measure start-up time of the command line entry points against a budget.
+
+Usage:
+    bench_startup.py [options]
+
+Options:
+    -h --help               Show this screen.
+    -n --repeat=<N>         Specify number of runs per case [default: 10].
+    --importtime            Show the slowest imports of each case.
+"""
+
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PATH = os.path.join(BASE_PATH, 'benchmarks')
+FIXTURE_PATH = os.path.join(BENCH_PATH, 'fixtures')
+# 单个账号的CTP2Excel运行（即封装脚本为每个账号启动的子进程），使用--TD跳过tushare
+ACCOUNT_ARGS = [
+    os.path.join(BASE_PATH, 'CTP2Excel.py'),
+    '-o', 'output',
+    '-s', '20181201',
+    '-e', '20181231',
+    '--TD', os.path.join(FIXTURE_PATH, 'td.csv'),
+    '--rebate-file', os.path.join(BASE_PATH, 'rebate.csv'),
+    '--broker-conf', os.path.join(BASE_PATH, 'brokers.yml'),
+    os.path.join(FIXTURE_PATH, 'CTP_20181203.txt'),
+]
+BUDGET = (
+    ('import CTP2Excel', ['-c', 'import CTP2Excel'], 0.15),
+    ('import CTP2ExcelWrapper', ['-c', 'import CTP2ExcelWrapper'], 0.30),  # asyncio约占40ms
+    ('CTP2Excel.py --help', ['CTP2Excel.py', '--help'], 0.15),
+    ('CTP2ExcelWrapper.py --help', ['CTP2ExcelWrapper.py', '--help'], 0.30),
+    ('CTP2Excel.py --TD <file>', ACCOUNT_ARGS, 5.00),
+)  # (用例, python参数, 启动时间预算/秒)
+# 单个账号运行中不应导入的模块：(模块, 仅允许在该模块之后导入)；None表示完全不应导入
+LAZY_IMPORTS = (
+    ('tushare', None),
+    ('matplotlib', 'xlsxwriter'),  # 仅在结算表写入之后的作图阶段导入
+)
+
+
+def measure(args, repeat, cwd):
+    """
+    多次运行取中位数耗时
+    """
+    elapsed = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=cwd, capture_output=True, check=True)
+        elapsed.append(time.perf_counter() - t0)
+    return sorted(elapsed)[len(elapsed) // 2]
+
+
+def slowest_imports(args, cwd, top=10):
+    """
+    使用 -X importtime 统计累计耗时最长的导入模块
+    """
+    res = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd, capture_output=True)
+    rows = []
+    for line in res.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        rows.append((int(cumulative), module.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def check_lazy_imports(args, cwd):
+    """
+    检查单个账号运行时较重依赖的导入顺序，返回违规说明列表
+    """
+    trace_file = os.path.join(cwd, 'imports.json')
+    subprocess.run(
+        [sys.executable, os.path.join(BENCH_PATH, 'trace_imports.py'), trace_file] + args,
+        cwd=cwd, capture_output=True, check=True
+    )
+    with open(trace_file, 'r', encoding='utf-8') as f:
+        modules = json.load(f)
+    violations = []
+    for module, after in LAZY_IMPORTS:
+        if module not in modules:
+            continue
+        if after is None:
+            violations.append('%s should not be imported' % module)
+        elif after not in modules or modules.index(module) < modules.index(after):
+            violations.append('%s imported before %s' % (module, after))
+    return violations
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    argv = docopt(__doc__)
+    repeat = int(argv['--repeat'])
+    work_dir = tempfile.mkdtemp()  # 单个账号运行的输出目录
+    try:
+        baseline = measure(['-c', 'pass'], repeat, BASE_PATH)
+        print('%-30s %10s %10s' % ('case', 'time(s)', 'budget(s)'))
+        print('%-30s %10.3f %10s' % ('python -c pass', baseline, '-'))
+        failures = []
+        for case, args, budget in BUDGET:
+            cwd = work_dir if args is ACCOUNT_ARGS else BASE_PATH
+            elapsed = measure(args, repeat, cwd)
+            print('%-30s %10.3f %10.3f%s' % (case, elapsed, budget, '' if elapsed <= budget else '  OVER BUDGET'))
+            if elapsed > budget:
+                failures.append(case)
+            if argv['--importtime']:
+                for cumulative, module in slowest_imports(args, cwd):
+                    print('    %8.1fms  %s' % (cumulative / 1000., module))
+        for violation in check_lazy_imports(ACCOUNT_ARGS, work_dir):
+            print('LAZY IMPORT VIOLATION: %s' % violation)
+            failures.append(violation)
+    finally:
+        shutil.rmtree(work_dir)
+    if len(failures) > 0:
+        sys.exit(1)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+"""Run a script as __main__ and record the order of its top-level imports.
+
+Usage:
+    trace_imports.py <trace-file> <script> [<arg>...]
+"""
+
+
+import os
+import sys
+import json
+import runpy
+
+
+class ImportRecorder(object):
+    """
+    记录首次导入的顶层模块，不参与实际导入
+    """
+    def __init__(self):
+        self.modules = []
+
+    def find_spec(self, name, path=None, target=None):
+        name = name.split('.')[0]
+        if name not in self.modules:
+            self.modules.append(name)
+        return None
+
+
+if __name__ == "__main__":
+    trace_file, script = sys.argv[1], sys.argv[2]
+    recorder = ImportRecorder()
+    sys.meta_path.insert(0, recorder)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    sys.argv = sys.argv[2:]
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            json.dump(recorder.modules, f)
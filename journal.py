@@ -0,0 +1,77 @@
+"""Append-only JSON-lines journal used to checkpoint and resume batch runs."""
+
+
+import json
+import os
+import traceback
+from datetime import datetime
+
+
+def file_signature(path):
+    """
+    获取文件签名（大小与修改时间），用于判断文件在两次运行之间是否发生变化
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_journal(path):
+    """
+    读取日志文件，返回各key对应的最新一条记录；中断写入造成的不完整行将被忽略
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['key']] = record
+    return records
+
+
+def append_journal(path, record):
+    """
+    追加一条记录并立即落盘
+    """
+    record = {**record, 'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    # 上次运行中断时最后一行可能不完整，先补齐换行避免与新记录粘连
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = '\n' + line
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def compact_journal(path, records):
+    """
+    以各key的最新记录重写日志文件（records为空时即清空日志），避免日志随运行次数无限增长
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in records.values():
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def error_record(key, signature, exc):
+    """
+    生成结构化的错误记录
+    """
+    return {
+        'key': key,
+        'signature': signature,
+        'status': 'error',
+        'error': type(exc).__name__,
+        'message': str(exc),
+        'traceback': traceback.format_exc(),
+    }